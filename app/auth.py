@@ -1,24 +1,57 @@
+import asyncio
+import hashlib
+import hmac
+import re
+import threading
+import time
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 
+from cachetools import TTLCache
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from jose import jwt, JWTError
+import jwt
+from jwt import InvalidTokenError
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHash, VerificationError
+from passlib.context import CryptContext
 from pydantic import BaseModel, EmailStr
-from sqlalchemy.orm import Session
-from os import getenv
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
 
+from .config import settings
 from .db import get_db
 from . import models
 
 
-SECRET_KEY = getenv("JWT_SECRET_KEY")
+SECRET_KEY = settings.JWT_SECRET_KEY
 if not SECRET_KEY:
     raise RuntimeError("JWT_SECRET_KEY is not set")
 
+# HS256 key prepared once as bytes: PyJWT would otherwise encode the str
+# secret on every encode/decode
+_SECRET_KEY_BYTES = SECRET_KEY.encode("utf-8")
+
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_HOURS = 168
 
+# argon2id via argon2-cffi directly: the login hot path skips passlib's
+# scheme dispatch. Built once at import.
+_PASSWORD_HASHER = PasswordHasher(
+    time_cost=settings.PASSWORD_ARGON2_TIME_COST,
+    memory_cost=settings.PASSWORD_ARGON2_MEMORY_COST,
+    parallelism=settings.PASSWORD_ARGON2_PARALLELISM,
+)
+_ARGON2_PREFIX = "$argon2"
+
+# Verified against on a login miss so unknown emails cost the same time
+# as wrong passwords (no user-enumeration timing signal).
+_DUMMY_HASH = _PASSWORD_HASHER.hash("storigrad-dummy-password")
+
+# passlib is kept only to verify legacy bcrypt_sha256 hashes, which get
+# upgraded to argon2id on the next successful login.
+_LEGACY_PWD_CONTEXT = CryptContext(schemes=["bcrypt_sha256"])
+
 
 class RegisterRequest(BaseModel):
     email: EmailStr
@@ -36,72 +69,160 @@ class AuthResponse(BaseModel):
     token: str
 
 
-def _hash_password_sha256(password: str) -> str:
-    import hashlib
+# legacy sha256 hex digest, matched in C instead of a per-char generator
+_LEGACY_SHA256_RE = re.compile(r"\A[0-9a-fA-F]{64}\Z")
+
 
+def _hash_password_sha256(password: str) -> str:
     return hashlib.sha256(password.encode("utf-8")).hexdigest()
 
 
 def hash_password(password: str) -> str:
-    """Hash password using bcrypt (new default)."""
-    # passlib provides safe salts + constant-time verification
-    from passlib.context import CryptContext
+    """Hash password using argon2id (new default)."""
+    return _PASSWORD_HASHER.hash(password)
 
-    pwd_context = CryptContext(schemes=["bcrypt_sha256"], deprecated="auto")
-    return pwd_context.hash(password)
+
+def _password_needs_rehash(stored_hash: str) -> bool:
+    """True for anything but an argon2id hash with the current parameters."""
+    if not stored_hash.startswith(_ARGON2_PREFIX):
+        return True
+    return _PASSWORD_HASHER.check_needs_rehash(stored_hash)
 
 
 def verify_password(password: str, stored_hash: str) -> bool:
-    """Verify against passlib hashes (bcrypt_sha256) + legacy sha256 hex."""
+    """Verify against argon2id, legacy bcrypt_sha256 and legacy sha256 hex."""
     if not stored_hash:
         return False
 
-    # bcrypt hashes usually start with "$2" (e.g., $2b$...)
-    from passlib.context import CryptContext
+    if stored_hash.startswith(_ARGON2_PREFIX):
+        try:
+            return _PASSWORD_HASHER.verify(stored_hash, password)
+        except (VerificationError, InvalidHash):
+            return False
 
-    pwd_context = CryptContext(schemes=["bcrypt_sha256"], deprecated="auto")
+    # passlib hashes start with "$" (e.g., $bcrypt-sha256$...)
     try:
-        if pwd_context.identify(stored_hash):
-            return pwd_context.verify(password, stored_hash)
+        if _LEGACY_PWD_CONTEXT.identify(stored_hash):
+            return _LEGACY_PWD_CONTEXT.verify(password, stored_hash)
     except Exception:
         return False
 
     # Legacy sha256 hex digest support
-    return _hash_password_sha256(password) == stored_hash
+    if _LEGACY_SHA256_RE.match(stored_hash) is None:
+        return False
+    return hmac.compare_digest(_hash_password_sha256(password), stored_hash)
+
+
+async def async_hash_password(password: str) -> str:
+    """hash_password for async routes: hashing runs in a worker thread."""
+    return await asyncio.to_thread(hash_password, password)
+
+
+async def async_verify_password(password: str, stored_hash: str) -> bool:
+    """verify_password for async routes: hashing runs in a worker thread."""
+    return await asyncio.to_thread(verify_password, password, stored_hash)
 
 
-def verify_and_upgrade_password(db: Session, user: models.User, password: str) -> bool:
-    """Verify password and upgrade legacy sha256 to bcrypt_sha256."""
+def verify_and_upgrade_password(
+    db: Session, user: Optional[models.User], password: str
+) -> bool:
+    """Verify password and upgrade legacy sha256 / bcrypt_sha256 to argon2id."""
     if not user or not getattr(user, "password_hash", None):
+        # same work as a real check, so a miss is not faster than a hit
+        verify_password(password, _DUMMY_HASH)
         return False
 
     ok = verify_password(password, user.password_hash)
     if not ok:
         return False
 
-    # Upgrade only legacy sha256 (64 hex chars)
-    is_legacy_sha256 = (
-        len(user.password_hash) == 64
-        and all(c in "0123456789abcdef" for c in user.password_hash.lower())
-    )
-
-    if is_legacy_sha256:
+    # Upgrade legacy sha256 / bcrypt_sha256 and outdated argon2 parameters
+    if _password_needs_rehash(user.password_hash):
         user.password_hash = hash_password(password)
         db.add(user)
         db.commit()
-        db.refresh(user)
 
     return True
 
 
+# user_id -> (token, exp timestamp); repeat logins reuse a fresh token
+_JWT_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+_JWT_CACHE_LOCK = threading.Lock()
+_JWT_REUSE_MIN_REMAINING_SECONDS = 120
+
+
 def create_jwt(user_id: int) -> str:
-    expire = datetime.now(timezone.utc) + timedelta(hours=ACCESS_TOKEN_EXPIRE_HOURS)
-    payload = {"user_id": user_id, "exp": expire}
-    return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+    now = time.time()
+    with _JWT_CACHE_LOCK:
+        cached = _JWT_CACHE.get(user_id)
+    if cached is not None:
+        token, exp = cached
+        if exp - now > _JWT_REUSE_MIN_REMAINING_SECONDS:
+            return token
+
+    issued_at = datetime.now(timezone.utc)
+    expire = issued_at + timedelta(hours=ACCESS_TOKEN_EXPIRE_HOURS)
+    # iat позволит позже отзывать токены, выпущенные до заданного момента
+    payload = {"user_id": user_id, "iat": issued_at, "exp": expire}
+    token = jwt.encode(payload, _SECRET_KEY_BYTES, algorithm=ALGORITHM)
+    with _JWT_CACHE_LOCK:
+        _JWT_CACHE[user_id] = (token, expire.timestamp())
+    return token
 
 
 security = HTTPBearer()
 
+# Verified tokens -> (user_id, exp timestamp). Keyed by a digest so raw
+# tokens never sit in memory; invalid tokens are never cached.
+_TOKEN_CACHE_TTL_SECONDS = settings.JWT_CACHE_TTL_SECONDS
+_TOKEN_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=_TOKEN_CACHE_TTL_SECONDS)
+_TOKEN_CACHE_LOCK = threading.Lock()
+
+
+def _decode_user_id(token: str) -> int:
+    """Return user_id from a valid token, reusing recent verifications."""
+    key = hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+    now = time.time()
+
+    with _TOKEN_CACHE_LOCK:
+        cached = _TOKEN_CACHE.get(key)
+    if cached is not None:
+        user_id, exp = cached
+        # never serve a token past its own expiry
+        if exp > now:
+            return user_id
+
+    # missing exp/user_id fail inside decode itself
+    payload = jwt.decode(
+        token,
+        _SECRET_KEY_BYTES,
+        algorithms=[ALGORITHM],
+        options={"require": ["exp", "user_id"]},
+    )
+    user_id = payload["user_id"]
+    with _TOKEN_CACHE_LOCK:
+        _TOKEN_CACHE[key] = (user_id, payload["exp"])
+    return user_id
+
+
+# user_id -> detached snapshot of the User row. Each request gets its own
+# session-bound copy via merge(load=False), so the snapshot is never shared.
+_USER_CACHE: TTLCache = TTLCache(maxsize=5_000, ttl=settings.USER_CACHE_TTL_SECONDS)
+_USER_CACHE_LOCK = threading.Lock()
+_USER_COLUMNS = tuple(attr.key for attr in inspect(models.User).column_attrs)
+
+
+def _snapshot_user(user: models.User) -> models.User:
+    snapshot = models.User(**{key: getattr(user, key) for key in _USER_COLUMNS})
+    make_transient_to_detached(snapshot)
+    return snapshot
+
+
+def invalidate_cached_user(user_id: int) -> None:
+    """Drop the cached row after writes to users (profile, stories_count)."""
+    with _USER_CACHE_LOCK:
+        _USER_CACHE.pop(user_id, None)
+
 
 def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
@@ -113,23 +234,24 @@ def get_current_user(
     """
     token = credentials.credentials
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: Optional[int] = payload.get("user_id")
-        if user_id is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid token payload.",
-            )
-    except JWTError:
+        user_id = _decode_user_id(token)
+    except InvalidTokenError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid or expired token.",
         )
 
-    user = db.query(models.User).get(user_id)
+    with _USER_CACHE_LOCK:
+        cached = _USER_CACHE.get(user_id)
+    if cached is not None:
+        return db.merge(cached, load=False)
+
+    user = db.get(models.User, user_id)
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found.",
         )
+    with _USER_CACHE_LOCK:
+        _USER_CACHE[user_id] = _snapshot_user(user)
     return user
\ No newline at end of file
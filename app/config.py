@@ -1,5 +1,6 @@
+from functools import lru_cache
 from pydantic_settings import BaseSettings
-from typing import List
+from typing import List, Optional
 
 class Settings(BaseSettings):
     CORS_ALLOW_ORIGINS: List[str] = [
@@ -9,23 +10,65 @@ class Settings(BaseSettings):
     ]
 
     database_url: str
+    # пул соединений: размер под число воркеров × запросов в полёте;
+    # за PgBouncer (transaction mode) включаем DB_USE_NULLPOOL
+    DB_POOL_SIZE: int = 20
+    DB_MAX_OVERFLOW: int = 40
+    DB_POOL_RECYCLE_SECONDS: int = 1800
+    DB_USE_NULLPOOL: bool = False
+    # кеш скомпилированных SQL-выражений на engine (по умолчанию у SQLAlchemy 500)
+    DB_QUERY_CACHE_SIZE: int = 1000
+    # создавать/обновлять схему при старте приложения (иначе: python -m app.init_db)
+    AUTO_MIGRATE: bool = False
 
     JWT_SECRET_KEY: str
     JWT_ALGORITHM: str
     JWT_EXPIRE_HOURS: int
+    # сколько секунд проверенный токен живёт в кэше (ограничивает задержку отзыва)
+    JWT_CACHE_TTL_SECONDS: int = 30
+    # сколько секунд строка пользователя живёт в кэше get_current_user
+    USER_CACHE_TTL_SECONDS: int = 10
+
+    # argon2id password hashing cost
+    PASSWORD_ARGON2_TIME_COST: int = 2
+    PASSWORD_ARGON2_MEMORY_COST: int = 64 * 1024  # KiB
+    PASSWORD_ARGON2_PARALLELISM: int = 1
+
+    # сколько ходов рассказчика одновременно ждут ответа LLM (на воркер)
+    STORY_STEP_CONCURRENCY: int = 128
 
     HF_TOKEN: str
 
     YANDEX_CLOUD_API_KEY: str
     YANDEX_CLOUD_PROJECT: str
+    YANDEX_CLOUD_BASE_URL: str = "https://rest-assistant.api.cloud.yandex.net/v1"
+    # agent prompt рассказчика по умолчанию (история может задать свой yc_agent_prompt_id)
+    YANDEX_CLOUD_AGENT_PROMPT_ID: Optional[str] = None
+    YANDEX_FIELD_ASSISTANT_PROMPT_ID: Optional[str] = None
+    # пул HTTP/2-соединений к Yandex Cloud (на процесс); с запасом над
+    # STORY_STEP_CONCURRENCY, чтобы ходы и помощник полей не ждали соединения
+    LLM_HTTP_MAX_CONNECTIONS: int = 256
+    LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS: int = 256
+    LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS: float = 30.0
+    # повторы SDK на 408/409/429/5xx и обрывы соединения (с учётом Retry-After)
+    LLM_MAX_RETRIES: int = 3
+    LLM_TIMEOUT_SECONDS: float = 60.0
 
     S3_BUCKET: str
 
     S3_ACCESS_KEY:  str
     S3_SECRET_KEY:  str
+    PUBLIC_CDN_URL: Optional[str] = None
+    MAX_IMAGE_SIZE_BYTES: int = 5 * 1024 * 1024
     
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
 
-settings = Settings()
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Единственный экземпляр настроек: .env читается один раз на процесс."""
+    return Settings()
+
+
+settings = get_settings()
@@ -1,6 +1,8 @@
 # server/app/db.py
+import orjson
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
+from sqlalchemy.pool import NullPool, QueuePool
 
 from .config import settings
 
@@ -9,18 +11,54 @@ class Base(DeclarativeBase):
     pass
 
 
+if settings.DB_USE_NULLPOOL:
+    # пулом владеет PgBouncer, второй пул поверх него только мешает
+    _pool_kwargs = {"poolclass": NullPool}
+else:
+    _pool_kwargs = {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_recycle": settings.DB_POOL_RECYCLE_SECONDS,
+        "pool_use_lifo": True,  # держим «горячими» несколько соединений
+    }
+
+def _json_serializer(value) -> str:
+    # psycopg2 ждёт str; orjson сериализует JSON/JSONB-колонки в разы быстрее json
+    return orjson.dumps(value).decode("utf-8")
+
+
 engine = create_engine(
     settings.database_url,
     future=True,
+    pool_pre_ping=True,  # переживаем рестарты БД без OperationalError
+    query_cache_size=settings.DB_QUERY_CACHE_SIZE,
+    json_serializer=_json_serializer,
+    json_deserializer=orjson.loads,
+    **_pool_kwargs,
 )
 
 SessionLocal = sessionmaker(
     autoflush=False,
     autocommit=False,
+    expire_on_commit=False,  # без лишнего SELECT на refresh после commit
     bind=engine,
 )
 
 
+def pool_status() -> dict:
+    """Текущая загрузка пула: исчерпание видно раньше, чем рост латентности."""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {"pool": type(pool).__name__}
+    return {
+        "pool": type(pool).__name__,
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+    }
+
+
 # зависимость для FastAPI
 def get_db():
     db = SessionLocal()
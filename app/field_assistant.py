@@ -1,26 +1,52 @@
-import os
-import json
+import re
 import asyncio
 from typing import Any, Dict, Optional
 
-from dotenv import load_dotenv
 import openai
+import orjson
 
-load_dotenv()
+from .config import settings
 
 # Yandex Cloud AI Studio (Assistant Responses API)
-YANDEX_CLOUD_API_KEY = os.getenv("YANDEX_CLOUD_API_KEY")
-YANDEX_CLOUD_PROJECT_ID = os.getenv("YANDEX_CLOUD_PROJECT")
 # Optional: prompt/assistant id if you configured it in AI Studio
-YANDEX_FIELD_ASSISTANT_PROMPT_ID = os.getenv("YANDEX_FIELD_ASSISTANT_PROMPT_ID")
-
-if not YANDEX_CLOUD_API_KEY:
-    raise RuntimeError("YANDEX_CLOUD_API_KEY is not set")
-
-client = openai.OpenAI(
-    api_key=YANDEX_CLOUD_API_KEY,
-    base_url="https://rest-assistant.api.cloud.yandex.net/v1",
-    project=YANDEX_CLOUD_PROJECT_ID,
+YANDEX_FIELD_ASSISTANT_PROMPT_ID = settings.YANDEX_FIELD_ASSISTANT_PROMPT_ID
+
+# Structured output: constrain the first answer to the shape _validate_schema
+# expects, so the repair round trip is only a rare fallback.
+_STORY_CONFIG_FORMAT = {
+    "type": "json_schema",
+    "name": "story_config",
+    "schema": {
+        "type": "object",
+        "properties": {
+            "story_description": {"type": "string"},
+            "player_description": {
+                "type": "object",
+                "properties": {"user": {"type": "string"}},
+                "required": ["user"],
+            },
+            "npc_description": {
+                "type": "object",
+                "additionalProperties": {"type": "string"},
+                "minProperties": 1,
+            },
+        },
+        "required": ["story_description", "player_description", "npc_description"],
+    },
+}
+
+# Leading ``` / ```json and trailing ``` of a markdown-fenced answer
+_FENCE_RE = re.compile(r"\A```(?:json)?\s*|\s*```\Z")
+
+# The model should receive only genre + user prompt.
+# Keep the user message simple and explicit.
+_USER_MESSAGE_TEMPLATE = "Жанр: {genre}\nЗапрос пользователя: {user_prompt}\n\n"
+
+_REPAIR_MESSAGE_TEMPLATE = (
+    "Твой предыдущий ответ не является валидным JSON по схеме. "
+    "Верни ТОЛЬКО валидный JSON-объект строго по формату (без markdown, без пояснений).\n\n"
+    "Жанр: {genre}\n"
+    "Запрос пользователя: {user_prompt}"
 )
 
 
@@ -53,16 +79,11 @@ def _extract_text_from_response(resp: Any) -> str:
 
 def _json_loads_strict(text: str) -> Dict[str, Any]:
     """Parse JSON from model output. Accepts raw JSON or fenced code blocks."""
-    s = (text or "").strip()
-
     # Strip markdown fences if present
-    if s.startswith("```"):
-        s = s.strip("`")
-        # If it was ```json ...
-        s = s.replace("json\n", "", 1)
+    s = _FENCE_RE.sub("", (text or "").strip())
 
-    # Try direct parse
-    return json.loads(s)
+    # orjson.JSONDecodeError is a ValueError, same as json's
+    return orjson.loads(s)
 
 
 def _validate_schema(obj: Dict[str, Any]) -> Dict[str, Any]:
@@ -92,7 +113,24 @@ def _validate_schema(obj: Dict[str, Any]) -> Dict[str, Any]:
     return obj
 
 
+async def _ask_assistant(llm: openai.AsyncOpenAI, user_message: str, **extra: Any) -> str:
+    """One Responses API call against the field assistant prompt; returns its text."""
+    # The assistant lives in AI Studio as a prompt id; there is no inline fallback
+    if not YANDEX_FIELD_ASSISTANT_PROMPT_ID:
+        raise RuntimeError("YANDEX_FIELD_ASSISTANT_PROMPT_ID is not set")
+
+    resp = await llm.responses.create(
+        prompt={
+            "id": YANDEX_FIELD_ASSISTANT_PROMPT_ID,
+        },
+        input=user_message,
+        **extra,
+    )
+    return _extract_text_from_response(resp)
+
+
 async def generate_story_config(
+    llm: openai.AsyncOpenAI,
     genre: str,
     user_prompt: str,
 ) -> Dict[str, Any]:
@@ -106,49 +144,22 @@ async def generate_story_config(
     if not user_prompt:
         raise ValueError("user_prompt is required")
 
-    # The model should receive only genre + user prompt.
-    # Keep the user message simple and explicit.
-    user_message = (
-        f"Жанр: {genre}\n"
-        f"Запрос пользователя: {user_prompt}\n\n"
-    )
-
-    # Preferred path: use prompt id if provided (AI Studio Agent/Prompt)
-    if YANDEX_FIELD_ASSISTANT_PROMPT_ID:
-        resp = client.responses.create(
-            prompt={
-                "id": YANDEX_FIELD_ASSISTANT_PROMPT_ID,
-            },
-            input=user_message,
-        )
-
-    text = _extract_text_from_response(resp)
+    user_message = _USER_MESSAGE_TEMPLATE.format(genre=genre, user_prompt=user_prompt)
+    text = await _ask_assistant(llm, user_message, text={"format": _STORY_CONFIG_FORMAT})
 
     try:
         obj = _json_loads_strict(text)
         return _validate_schema(obj)
     except Exception:
         # Repair pass: force the assistant to output valid JSON only
-        repair_user = (
-            "Твой предыдущий ответ не является валидным JSON по схеме. "
-            "Верни ТОЛЬКО валидный JSON-объект строго по формату (без markdown, без пояснений).\n\n"
-            f"Жанр: {genre}\n"
-            f"Запрос пользователя: {user_prompt}"
-        )
-
-        if YANDEX_FIELD_ASSISTANT_PROMPT_ID:
-            resp2 = client.responses.create(
-                prompt={
-                    "id": YANDEX_FIELD_ASSISTANT_PROMPT_ID,
-                },
-                input=repair_user,
-            )
-
-        text2 = _extract_text_from_response(resp2)
+        repair_user = _REPAIR_MESSAGE_TEMPLATE.format(genre=genre, user_prompt=user_prompt)
+        text2 = await _ask_assistant(llm, repair_user)
         obj2 = _json_loads_strict(text2)
         return _validate_schema(obj2)
 
 
 # Backwards-compatible wrapper name (if other code imports it)
-async def generate_field_values(genre: str, user_prompt: str) -> Dict[str, Any]:
-    return await generate_story_config(genre=genre, user_prompt=user_prompt)
\ No newline at end of file
+async def generate_field_values(
+    llm: openai.AsyncOpenAI, genre: str, user_prompt: str
+) -> Dict[str, Any]:
+    return await generate_story_config(llm, genre=genre, user_prompt=user_prompt)
\ No newline at end of file
@@ -0,0 +1,77 @@
+# server/app/init_db.py
+"""
+Инициализация схемы БД вне процесса, который обслуживает запросы.
+
+Запуск: python -m app.init_db
+"""
+from sqlalchemy import text
+
+from .db import Base, engine
+from . import models  # noqa: F401  регистрирует таблицы в Base.metadata
+
+
+def _to_jsonb(table: str, column: str) -> str:
+    """Перевести колонку json -> jsonb, если она ещё не переведена."""
+    return (
+        "DO $$ BEGIN "
+        "IF (SELECT data_type FROM information_schema.columns "
+        f"WHERE table_name = '{table}' AND column_name = '{column}') = 'json' THEN "
+        f"ALTER TABLE {table} ALTER COLUMN {column} TYPE jsonb USING {column}::jsonb; "
+        "END IF; "
+        "END $$"
+    )
+
+
+# create_all не меняет уже существующие таблицы, поэтому правки схемы
+# для старых баз лежат здесь. Каждая команда должна быть идемпотентной.
+_UPGRADES = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email_lower ON users (lower(email))",
+    # ходы удаляются вместе с историей на стороне БД; ключ пересоздаётся,
+    # только если он ещё не ON DELETE CASCADE (иначе каждый старт брал бы
+    # эксклюзивную блокировку story_turns и перепроверял все строки)
+    "DO $$ BEGIN "
+    "IF NOT EXISTS (SELECT 1 FROM pg_constraint "
+    "WHERE conname = 'story_turns_story_id_fkey' "
+    "AND conrelid = 'story_turns'::regclass AND confdeltype = 'c') THEN "
+    "ALTER TABLE story_turns DROP CONSTRAINT IF EXISTS story_turns_story_id_fkey, "
+    "ADD CONSTRAINT story_turns_story_id_fkey FOREIGN KEY (story_id) "
+    "REFERENCES stories (id) ON DELETE CASCADE; "
+    "END IF; "
+    "END $$",
+    _to_jsonb("story_turns", "turns"),
+    _to_jsonb("stories", "config"),
+    "ALTER TABLE story_turns ALTER COLUMN turns SET DEFAULT '[]'::jsonb",
+    "CREATE INDEX IF NOT EXISTS ix_stories_config_gin ON stories USING gin (config)",
+    "CREATE INDEX IF NOT EXISTS ix_stories_owner_updated "
+    "ON stories (owner_id, updated_at DESC)",
+    "CREATE INDEX IF NOT EXISTS ix_stories_templates_updated "
+    "ON stories (updated_at DESC) WHERE owner_id IS NULL",
+    # одна строка ходов на историю; лишние строки никогда не читались
+    # (и add_turn, и get_turns брали первую по id)
+    "DELETE FROM story_turns a USING story_turns b "
+    "WHERE a.story_id = b.story_id AND a.id > b.id",
+    "DO $$ BEGIN "
+    "IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_story_turns_story') THEN "
+    "ALTER TABLE story_turns ADD CONSTRAINT uq_story_turns_story UNIQUE (story_id); "
+    "END IF; "
+    "END $$",
+    # уникальный индекс constraint'а заменяет прежний обычный
+    "DROP INDEX IF EXISTS ix_story_turns_story_id",
+)
+
+
+# ключ advisory-lock: DDL выполняет только один процесс за раз
+_INIT_DB_LOCK_KEY = 827301
+
+
+def init_db() -> None:
+    with engine.begin() as conn:
+        # держится до конца транзакции; остальные воркеры ждут здесь
+        conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _INIT_DB_LOCK_KEY})
+        Base.metadata.create_all(bind=conn)
+        for stmt in _UPGRADES:
+            conn.execute(text(stmt))
+
+
+if __name__ == "__main__":
+    init_db()
@@ -0,0 +1,35 @@
+# app/llm.py
+import httpx
+import openai
+
+from .config import settings
+
+# Один пул соединений на все вызовы Yandex Cloud: TLS-рукопожатие
+# платим один раз, HTTP/2 мультиплексирует параллельные запросы.
+_HTTP_LIMITS = httpx.Limits(
+    max_connections=settings.LLM_HTTP_MAX_CONNECTIONS,
+    max_keepalive_connections=settings.LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    # простаивающее соединение держим дольше паузы между ходами игрока
+    keepalive_expiry=settings.LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS,
+)
+_HTTP_TIMEOUT = httpx.Timeout(settings.LLM_TIMEOUT_SECONDS, connect=5.0)
+
+
+def create_async_client() -> openai.AsyncOpenAI:
+    """
+    AsyncOpenAI-клиент к Yandex Cloud со своим пулом HTTP/2-соединений.
+
+    Создаётся один раз в lifespan приложения (app.state.llm) и передаётся
+    в генераторы явно; закрывать — await client.close() при остановке.
+    Повторы с экспоненциальной паузой (и Retry-After на 429) делает сам SDK.
+    """
+    return openai.AsyncOpenAI(
+        api_key=settings.YANDEX_CLOUD_API_KEY,
+        base_url=settings.YANDEX_CLOUD_BASE_URL,
+        project=settings.YANDEX_CLOUD_PROJECT,
+        http_client=httpx.AsyncClient(
+            http2=True, limits=_HTTP_LIMITS, timeout=_HTTP_TIMEOUT
+        ),
+        timeout=_HTTP_TIMEOUT,
+        max_retries=settings.LLM_MAX_RETRIES,
+    )
@@ -1,20 +1,40 @@
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File
-from fastapi.responses import RedirectResponse, Response
+import anyio
+from fastapi import FastAPI, Depends, HTTPException, Request, status, UploadFile, File
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+import asyncio
+import heapq
+import logging
+import queue
+import sys
+import orjson
+import threading
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
 from time import perf_counter
 from app.schemas import InferenceRequest, InferenceResponse, HealthResponse, StoryStepIn
 from app.service import get_pipeline, Pipeline
 from app.config import settings
-from app.storage import image_storage
-from pydantic import BaseModel, EmailStr
-from typing import Dict, Optional, Any, Literal
+from app.storage import ImageNotModified, image_storage, MAX_IMAGE_SIZE_BYTES
+from pydantic import BaseModel, ConfigDict, EmailStr
+from cachetools import TTLCache
+from typing import Callable, Dict, List, Optional, Any, Literal
 import hashlib
+import os
 from datetime import datetime, timezone
+from sqlalchemy import delete, func, insert, select, update
 from sqlalchemy.orm import Session
-from .db import Base, engine, get_db
+from .db import get_db, pool_status
+from .init_db import init_db
 from . import models, story
-from .storyteller_mini import generate_story_step
-from jose import jwt
+from .storyteller_mini import (
+    StoryNotFound,
+    StoryStepFailed,
+    drain_pending_saves,
+    generate_story_step,
+    prepare_story_stream,
+)
 from datetime import timedelta
 from .auth import (
     RegisterRequest,
@@ -23,18 +43,106 @@ from .auth import (
     hash_password,
     create_jwt,
     get_current_user,
+    invalidate_cached_user,
     verify_and_upgrade_password,
 )
 from .field_assistant import generate_story_config
+from .llm import create_async_client
+
+class StoryCreate(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    title: Optional[str] = None
+    config: Optional[dict] = None
+    genre: Optional[str] = None
+    cover_url: Optional[str] = None
 
 class StoryUpdate(BaseModel):
     title: Optional[str] = None
     config: Optional[dict] = None
     cover_url: Optional[str] = None
 
-app = FastAPI(title="Storigrad API", version="0.1.0")
+class TurnIn(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
+    # пустые значения отсекаются в обработчике (400, как и раньше)
+    user_text: str = ""
+    model_text: str = ""
 
-Base.metadata.create_all(bind=engine)
+class _ContextFormatter(logging.Formatter):
+    """Дописывает к строке лога поля контекста из extra= (story_id), если они есть."""
+
+    _CONTEXT_FIELDS = ("story_id",)
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        line = super().formatMessage(record)
+        context = " ".join(
+            f"{field}={getattr(record, field)}"
+            for field in self._CONTEXT_FIELDS
+            if hasattr(record, field)
+        )
+        return f"{line} [{context}]" if context else line
+
+
+def _start_log_listener() -> Callable[[], None]:
+    """
+    Логгеры пакета app пишут в очередь, а вывод в stdout делает отдельный
+    поток: запрос не ждёт записи в pipe контейнера.
+
+    Возвращает функцию остановки: она снимает QueueHandler с логгера
+    (повторный старт lifespan не задвоит строки, а записи после остановки
+    не уйдут в очередь, которую никто не читает) и дописывает хвост очереди.
+    """
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(
+        _ContextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    )
+    queue_handler = QueueHandler(log_queue)
+    app_logger = logging.getLogger("app")
+    app_logger.addHandler(queue_handler)
+    app_logger.setLevel(logging.INFO)
+    app_logger.propagate = False
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+
+    def stop() -> None:
+        app_logger.removeHandler(queue_handler)
+        app_logger.propagate = True
+        listener.stop()
+
+    return stop
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    stop_log_listener = _start_log_listener()
+    try:
+        # Ход рассказчика ждёт LLM секундами; лимит ограничивает число
+        # одновременных обращений к модели с одного воркера.
+        app.state.story_step_limiter = anyio.CapacityLimiter(settings.STORY_STEP_CONCURRENCY)
+        # один AsyncOpenAI (и его пул соединений) на процесс, передаётся явно
+        app.state.llm = create_async_client()
+        try:
+            if settings.AUTO_MIGRATE:
+                # под advisory-lock: при нескольких воркерах DDL выполнит один
+                await asyncio.to_thread(init_db)
+            yield
+        finally:
+            # записи ходов оборванных запросов не должны потеряться при остановке воркера
+            await drain_pending_saves()
+            await app.state.llm.close()
+    finally:
+        stop_log_listener()
+
+
+app = FastAPI(
+    title="Storigrad API",
+    version="0.1.0",
+    lifespan=lifespan,
+    # orjson кодирует datetime и вложенные dict на C, а не в цикле Python
+    default_response_class=ORJSONResponse,
+)
 
 app.add_middleware(
 CORSMiddleware,
@@ -44,54 +152,100 @@ allow_methods=["*"],
 allow_headers=["*"],
 )
 
+# Сжимаем только JSON API. SSE — мимо: GZipMiddleware копит куски в буфере
+# сжатия, и дельты рассказчика пришли бы клиенту пачкой (не все версии
+# Starlette сами пропускают text/event-stream). Картинки — мимо: PNG/JPEG/WEBP
+# уже сжаты, а gzip снял бы Content-Length и отдал обе кодировки под одним ETag.
+_UNCOMPRESSED_PATH_PREFIXES = ("/api/story_step/stream", "/images/")
+
+
+class _GZipExceptStreams(GZipMiddleware):
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "http" and scope["path"].startswith(_UNCOMPRESSED_PATH_PREFIXES):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+# большие config/turns в /stories сжимаются; мелкие ответы идут как есть
+app.add_middleware(_GZipExceptStreams, minimum_size=1024)
+
+# Тело /health неизменно: сериализуем один раз и отдаём готовый Response,
+# минуя Pydantic и JSON-кодирование на каждом пробе балансировщика.
+_HEALTH_RESPONSE = Response(
+    content=b'{"status":"ok"}',
+    media_type="application/json",
+    headers={"Cache-Control": "max-age=5"},
+)
+
+
 @app.get("/health", response_model=HealthResponse)
-def health() -> HealthResponse:
-    return HealthResponse(status="ok")
+def health():
+    return _HEALTH_RESPONSE
+
+
+@app.get("/health/db")
+def health_db():
+    return pool_status()
 
 
-@app.post("/auth/register", response_model=AuthResponse)
-def register(req: RegisterRequest, db: Session = Depends(get_db)) -> AuthResponse:
+# AuthResponse остаётся только для OpenAPI: тело отдаём готовым dict без
+# повторной валидации через response_model.
+@app.post(
+    "/auth/register",
+    responses={200: {"model": AuthResponse}},
+)
+def register(req: RegisterRequest, db: Session = Depends(get_db)):
     email = req.email.lower()
 
-    existing = db.query(models.User).filter(models.User.email == email).first()
-    if existing:
+    existing = db.execute(
+        select(models.User.id).where(func.lower(models.User.email) == email).limit(1)
+    ).scalar_one_or_none()
+    if existing is not None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="User with this email already exists.",
         )
 
-    user = models.User(
-        email=email,
-        username=req.username,
-        password_hash=hash_password(req.password),
-        plan="Free",
-        stories_count=0,
+    # Core insert: объект User после регистрации не нужен, unit-of-work лишний
+    db.execute(
+        insert(models.User).values(
+            email=email,
+            username=req.username,
+            password_hash=hash_password(req.password),
+            plan="Free",
+            stories_count=0,
+        )
     )
-    db.add(user)
     db.commit()
-    db.refresh(user)
 
-    return AuthResponse(message="User registered successfully.", token="")
+    return {"message": "User registered successfully.", "token": ""}
 
 
-@app.post("/auth/login", response_model=AuthResponse)
-def login(req: LoginRequest, db: Session = Depends(get_db)) -> AuthResponse:
+@app.post(
+    "/auth/login",
+    responses={200: {"model": AuthResponse}},
+)
+def login(req: LoginRequest, db: Session = Depends(get_db)):
     email = req.email.lower()
-    user = db.query(models.User).filter(models.User.email == email).first()
+    user = db.execute(
+        select(models.User).where(func.lower(models.User.email) == email).limit(1)
+    ).scalar_one_or_none()
 
-    if not user or not verify_and_upgrade_password(db, user, req.password):
+    # verify runs even when the user is missing: constant-time miss path
+    if not verify_and_upgrade_password(db, user, req.password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid email or password.",
         )
 
     token = create_jwt(user.id)
-    return AuthResponse(message="Login successful.", token=token)
+    return {"message": "Login successful.", "token": token}
 
 
 @app.post("/stories")
 def create_story_endpoint(
-    payload: dict,
+    payload: StoryCreate,
     db: Session = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
@@ -104,26 +258,21 @@ def create_story_endpoint(
       "start_phrase": "..."
     }
     """
-    title = payload.get("title")
-    config = payload.get("config")
-    genre = payload.get("genre")
-    cover_url = payload.get("cover_url")
-    db_story = story.create_story(
+    title = payload.title
+    config = payload.config
+    genre = payload.genre
+    cover_url = payload.cover_url
+    # инкремент stories_count уходит в ту же транзакцию, что и вставка истории
+    story_id = story.create_story(
       db=db,
       owner_id=current_user.id,
       genre=genre,
       config=config,
       title=title,  # позже можно добавить поле названия на фронте
+      cover_url=cover_url,  # cover_url хранится вне config
     )
-    # cover_url хранится вне config
-    if cover_url is not None:
-        setattr(db_story, "cover_url", cover_url)
-        db.add(db_story)
-    db.query(models.User).filter(models.User.id == current_user.id).update(
-        {models.User.stories_count: models.User.stories_count + 1}
-    )
-    db.commit()
-    return {"id": db_story.id}
+    invalidate_cached_user(current_user.id)
+    return {"id": story_id}
 
 @app.put("/stories/{story_id}")
 def update_story_endpoint(
@@ -149,17 +298,19 @@ def update_story_endpoint(
     if payload.title is not None:
         db_story.title = payload.title
     if payload.config is not None:
-        db_story.config = payload.config
+        db_story.config = story.with_prompt_cache(payload.config)
     if payload.cover_url is not None:
         setattr(db_story, "cover_url", payload.cover_url)
 
     db.commit()
     db.refresh(db_story)
+    if db_story.owner_id is None:
+        invalidate_template_stories()
 
     return {
         "id": db_story.id,
         "title": db_story.title,
-        "config": db_story.config,
+        "config": story.without_prompt_cache(db_story.config),
         "cover_url": getattr(db_story, "cover_url", None),
     }
 
@@ -169,11 +320,7 @@ def delete_story_endpoint(
     db: Session = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
-    db_story = (
-        db.query(models.Story)
-        .filter(models.Story.id == story_id)
-        .first()
-    )
+    db_story = db.get(models.Story, story_id)
 
     if not db_story:
         raise HTTPException(status_code=404, detail="История не найдена")
@@ -186,49 +333,81 @@ def delete_story_endpoint(
     if db_story.owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="Нет доступа к удалению этой истории")
 
-    # Удаляем связанные turns (на случай, если нет каскада)
-    db.query(models.StoryTurn).filter(models.StoryTurn.story_id == story_id).delete()
-
-    # Удаляем саму историю
-    db.delete(db_story)
+    # Удаляем историю одним DELETE; turns удаляются каскадом на стороне БД
+    db.execute(delete(models.Story).where(models.Story.id == story_id))
 
-    # Обновляем счётчик историй пользователя (не ниже 0)
-    if getattr(current_user, "stories_count", None) is not None:
-        new_count = max(0, int(current_user.stories_count) - 1)
-        db.query(models.User).filter(models.User.id == current_user.id).update(
-            {models.User.stories_count: new_count}
-        )
+    # Обновляем счётчик историй пользователя (не ниже 0) атомарно в SQL,
+    # без чтения возможно устаревшего current_user.stories_count
+    db.execute(
+        update(models.User)
+        .where(models.User.id == current_user.id)
+        .values(stories_count=func.greatest(models.User.stories_count - 1, 0))
+        .execution_options(synchronize_session=False)
+    )
 
     db.commit()
+    invalidate_cached_user(current_user.id)
 
     return {"ok": True}
 
+def _story_summary(s: models.Story) -> Dict[str, Any]:
+    return {
+        "id": s.id,
+        "owner_id": s.owner_id,
+        "title": s.title,
+        "config": story.without_prompt_cache(s.config),
+        "cover_url": getattr(s, "cover_url", None),
+        "npc_avatars": getattr(s, "npc_avatars", None),
+        "created_at": s.created_at,
+        "updated_at": s.updated_at,
+        "genre": s.genre,
+    }
+
+
+# Шаблоны почти не меняются, а отдаются в каждом /stories: держим их
+# уже сериализованными и не ходим за ними в БД чаще раза в 5 минут.
+_TEMPLATE_STORIES_CACHE: TTLCache = TTLCache(maxsize=1, ttl=300)
+_TEMPLATE_STORIES_LOCK = threading.Lock()
+
+
+def _template_story_summaries(db: Session) -> List[Dict[str, Any]]:
+    with _TEMPLATE_STORIES_LOCK:
+        cached = _TEMPLATE_STORIES_CACHE.get("templates")
+    if cached is not None:
+        return cached
+
+    summaries = [_story_summary(s) for s in story.list_template_stories(db)]
+    with _TEMPLATE_STORIES_LOCK:
+        _TEMPLATE_STORIES_CACHE["templates"] = summaries
+    return summaries
+
+
+def invalidate_template_stories() -> None:
+    with _TEMPLATE_STORIES_LOCK:
+        _TEMPLATE_STORIES_CACHE.clear()
+
+
 @app.get("/stories")
 def list_stories_endpoint(
     db: Session = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
-    stories = story.list_stories_for_user(db, owner_id=current_user.id)
-    return [
-        {
-            "id": s.id,
-            "owner_id": s.owner_id,
-            "title": s.title,
-            "config": s.config,
-            "cover_url": getattr(s, "cover_url", None),
-            "npc_avatars": getattr(s, "npc_avatars", None),
-            "created_at": s.created_at,
-            "updated_at": s.updated_at,
-            "genre": s.genre,
-        }
-        for s in stories
-    ]
+    owned = [_story_summary(s) for s in story.list_owned_stories(db, owner_id=current_user.id)]
+    # оба списка уже отсортированы по updated_at desc — просто сливаем
+    return list(
+        heapq.merge(
+            owned,
+            _template_story_summaries(db),
+            key=lambda s: s["updated_at"],
+            reverse=True,
+        )
+    )
 
 
 @app.post("/stories/{story_id}/turns")
 def add_turn_endpoint(
     story_id: int,
-    body: dict,
+    body: TurnIn,
     db: Session = Depends(get_db),
     current_user=Depends(get_current_user),
 ):
@@ -237,8 +416,8 @@ def add_turn_endpoint(
     if not db_story:
         raise HTTPException(status_code=404, detail="История не найдена")
 
-    user_text = body.get("user_text", "")
-    model_text = body.get("model_text", "")
+    user_text = body.user_text
+    model_text = body.model_text
     if not user_text or not model_text:
         raise HTTPException(
             status_code=400,
@@ -265,51 +444,29 @@ def get_story_endpoint(
     current_user=Depends(get_current_user),
 ):
     # Пытаемся получить историю (разрешаем owner_id == NULL — шаблон)
-    db_story = (
-        db.query(models.Story)
-        .filter(models.Story.id == story_id)
-        .first()
-    )
+    db_story = db.get(models.Story, story_id)
 
     if not db_story:
         raise HTTPException(status_code=404, detail="История не найдена")
 
     # Если это шаблон — создаём (или переиспользуем) копию для пользователя
     if db_story.owner_id is None:
-        # 2. Создаём копию шаблона
-        copied_story = models.Story(
-            owner_id=current_user.id,
-            title=db_story.title,
-            genre=db_story.genre,
-            config=db_story.config,
-            cover_url=getattr(db_story, "cover_url", None),
-            npc_avatars=getattr(db_story, "npc_avatars", None),
-        )
-        db.add(copied_story)
-        db.commit()
-        db.refresh(copied_story)
-
-        # инкремент счётчика историй пользователя
-        db.query(models.User).filter(models.User.id == current_user.id).update(
-            {models.User.stories_count: models.User.stories_count + 1}
-        )
-        db.commit()
-
-        db_story = copied_story
-
-        copy_id = copied_story.id
-        # Проверка доступа: после копирования история обязана принадлежать пользователю
-        if db_story.owner_id != current_user.id:
-            raise HTTPException(status_code=403, detail="Нет доступа к истории")
-        return RedirectResponse(url=f"/stories/{copy_id}", status_code=307)
-    
-    # Получаем ходы уже КОПИИ истории
-    turns = story.get_turns(db, story_id=db_story.id)
+        # 2. Создаём копию шаблона (вставка и инкремент счётчика — один commit)
+        story_id = story.copy_story(db, db_story, owner_id=current_user.id)
+        invalidate_cached_user(current_user.id)
+
+        # Отдаём копию сразу, без 307 на /stories/{copy_id}: клиенту не нужен
+        # второй запрос с повторной проверкой JWT и чтением истории.
+        # У свежей копии ходов ещё нет, остальные поля совпадают с шаблоном.
+        turns = []
+    else:
+        # Последние ходы режет сама БД: по сети идут только они, а не вся история
+        turns = story.get_turns(db, story_id=story_id)
 
     return {
-        "id": db_story.id,
+        "id": story_id,
         "title": db_story.title,
-        "config": db_story.config,
+        "config": story.without_prompt_cache(db_story.config),
         "cover_url": getattr(db_story, "cover_url", None),
         "turns": turns,
         "npc_avatars": getattr(db_story, "npc_avatars", None),
@@ -322,11 +479,7 @@ def duplicate_story_endpoint(
     current_user=Depends(get_current_user),
 ):
     # Получаем исходную историю (шаблон или пользовательскую)
-    source_story = (
-        db.query(models.Story)
-        .filter(models.Story.id == story_id)
-        .first()
-    )
+    source_story = db.get(models.Story, story_id)
 
     if not source_story:
         raise HTTPException(status_code=404, detail="История не найдена")
@@ -335,54 +488,98 @@ def duplicate_story_endpoint(
     if source_story.owner_id is not None and source_story.owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="Нет доступа к истории")
 
-    # Создаём копию
-    copied_story = models.Story(
-        owner_id=current_user.id,
-        title=source_story.title,
-        genre=source_story.genre,
-        config=source_story.config,
-        cover_url=getattr(source_story, "cover_url", None),
-        npc_avatars=getattr(source_story, "npc_avatars", None),
-    )
+    # Создаём копию; вставка и инкремент счётчика историй — одна транзакция
+    copy_id = story.copy_story(db, source_story, owner_id=current_user.id)
+    invalidate_cached_user(current_user.id)
 
-    # Если дублируем шаблон — сохраняем связь с ним
-    if source_story.owner_id is None and hasattr(copied_story, "template_id"):
-        copied_story.template_id = source_story.id
+    return {"id": copy_id}
 
-    db.add(copied_story)
-    db.commit()
-    db.refresh(copied_story)
+@app.post("/api/story_step")
+async def story_step(
+    payload: StoryStepIn,
+    request: Request,
+    current_user=Depends(get_current_user),
+):
+    # payload должен содержать story_id и user_input; соединение с БД ход
+    # берёт сам и только на время чтения/записи, не на время вызова модели
+    try:
+        async with request.app.state.story_step_limiter:
+            text = await generate_story_step(
+                request.app.state.llm,
+                story_id=payload.story_id,
+                user_id=current_user.id,
+                user_input=payload.user_input,
+                mode=payload.mode,
+            )
+    except StoryNotFound:
+        # тот же ответ, что и у /api/story_step/stream
+        raise HTTPException(status_code=404, detail="История не найдена")
+    return {"reply": text}
 
-    # Инкремент счётчика историй пользователя
-    db.query(models.User).filter(models.User.id == current_user.id).update(
-        {models.User.stories_count: models.User.stories_count + 1}
-    )
-    db.commit()
 
-    return {"id": copied_story.id}
+def _sse_event(data: Dict[str, Any], event: Optional[str] = None) -> bytes:
+    prefix = f"event: {event}\n".encode() if event else b""
+    return prefix + b"data: " + orjson.dumps(data) + b"\n\n"
 
-@app.post("/api/story_step")
-def story_step(payload: StoryStepIn, db: Session = Depends(get_db), current_user=Depends(get_current_user)):
-    # payload должен содержать story_id и user_input
-    text = generate_story_step(
-        db=db,
-        story_id=payload.story_id,
-        user_id=current_user.id,
-        user_input=payload.user_input,
-        mode=payload.mode,
+
+@app.post("/api/story_step/stream")
+async def story_step_stream(
+    payload: StoryStepIn,
+    request: Request,
+    current_user=Depends(get_current_user),
+):
+    """
+    Ход рассказчика через SSE: куски текста приходят событиями
+    `data: {"delta": "..."}` по мере генерации, в конце — `event: done`.
+    Если модель не ответила или оборвала поток — `event: error` вместо done.
+    Клиент видит первые слова, не дожидаясь всего ответа модели.
+    """
+    limiter = request.app.state.story_step_limiter
+
+    # доступ проверяем до StreamingResponse: после заголовков 200 отдать 404 уже нельзя
+    try:
+        deltas = await prepare_story_stream(
+            request.app.state.llm,
+            story_id=payload.story_id,
+            user_id=current_user.id,
+            user_input=payload.user_input,
+            mode=payload.mode,
+        )
+    except StoryNotFound:
+        raise HTTPException(status_code=404, detail="История не найдена")
+
+    async def events():
+        async with limiter:
+            try:
+                async for delta in deltas:
+                    yield _sse_event({"delta": delta})
+            except StoryStepFailed as exc:
+                yield _sse_event({"detail": str(exc)}, event="error")
+                return
+        yield _sse_event({}, event="done")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # прокси не должны буферизовать поток
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    return {"reply": text}
 
 class FieldAssistantRequest(BaseModel):
     user_prompt: str
     genre: str
 
 @app.post("/api/field_assistant")
-async def field_assistant(req: FieldAssistantRequest, current_user=Depends(get_current_user)):
+async def field_assistant(
+    req: FieldAssistantRequest,
+    request: Request,
+    current_user=Depends(get_current_user),
+):
     """
     Генерация полного конфига истории с помощью AI (жанр + заявка пользователя).
     """
     config = await generate_story_config(
+        request.app.state.llm,
         genre=req.genre,
         user_prompt=req.user_prompt,
     )
@@ -442,12 +639,15 @@ def update_user(
     if req.email is not None:
         new_email = str(req.email).strip().lower()
         if new_email:
-            existing = (
-                db.query(models.User)
-                .filter(models.User.email == new_email, models.User.id != current_user.id)
-                .first()
-            )
-            if existing:
+            existing = db.execute(
+                select(models.User.id)
+                .where(
+                    func.lower(models.User.email) == new_email,
+                    models.User.id != current_user.id,
+                )
+                .limit(1)
+            ).scalar_one_or_none()
+            if existing is not None:
                 raise HTTPException(
                     status_code=status.HTTP_400_BAD_REQUEST,
                     detail="User with this email already exists.",
@@ -483,6 +683,7 @@ def update_user(
     db.add(current_user)
     db.commit()
     db.refresh(current_user)
+    invalidate_cached_user(current_user.id)
 
     user_out = ProfileUserOut(
         id=current_user.id,
@@ -502,32 +703,55 @@ async def upload_image(image: UploadFile = File(...)):
     if image.content_type not in ("image/png", "image/jpeg", "image/webp"):
         raise HTTPException(status_code=400, detail="Invalid image type")
 
-    file_bytes = await image.read()
+    # Starlette уже спулит тело во временный файл: узнаём размер без чтения
+    # в память и отдаём поток в S3 как есть
+    fileobj = image.file
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
 
-    if len(file_bytes) > 30000000:
-        raise HTTPException(status_code=400, detail="File too large")
+    if size > MAX_IMAGE_SIZE_BYTES:
+        raise HTTPException(status_code=413, detail="File too large")
 
-    url = image_storage.upload_image(
-        file_bytes=file_bytes,
-        content_type=image.content_type,
-    )
+    try:
+        url = await image_storage.upload_image_async(
+            fileobj=fileobj,
+            content_type=image.content_type,
+            size=size,
+        )
+    except ValueError:
+        # содержимое не совпало ни с одной сигнатурой PNG/JPEG/WEBP
+        raise HTTPException(status_code=400, detail="Invalid image type")
 
     return {"url": url}
 
 
+# Ключи картинок — uuid, содержимое по ключу не меняется
+_IMAGE_CACHE_CONTROL = "public, max-age=86400, immutable"
+
+
 @app.get("/images/{image_name}")
-def get_image(image_name: str):
+def get_image(image_name: str, request: Request):
     key = f"images/{image_name}"
 
     try:
-        data, content_type = image_storage.get_image(key)
+        chunks, content_type, etag, size = image_storage.get_image(
+            key, if_none_match=request.headers.get("if-none-match")
+        )
+    except ImageNotModified as e:
+        # 304 без тела: S3 тоже не отдавал байты
+        return Response(
+            status_code=304,
+            headers={"ETag": e.etag, "Cache-Control": _IMAGE_CACHE_CONTROL},
+        )
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Image not found")
 
-    return Response(
-        content=data,
-        media_type=content_type,
-        headers={
-            "Cache-Control": "public, max-age=86400",
-        },
-    )
\ No newline at end of file
+    headers = {
+        "ETag": etag,
+        "Cache-Control": _IMAGE_CACHE_CONTROL,
+    }
+    if size is not None:
+        headers["Content-Length"] = str(size)
+    # тело идёт из S3 клиенту частями, без копии всей картинки в памяти
+    return StreamingResponse(chunks, media_type=content_type, headers=headers)
\ No newline at end of file
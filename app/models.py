@@ -1,6 +1,7 @@
 # server/app/models.py
 from datetime import datetime, timezone
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, JSON
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, JSON, Index, UniqueConstraint, func, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import Mapped, mapped_column
 
@@ -20,6 +21,10 @@ class User(Base):
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), nullable=False)
 
 
+# логин/регистрация ищут по lower(email)
+Index("ix_users_email_lower", func.lower(User.email), unique=True)
+
+
 class Story(Base):
     __tablename__ = "stories"
 
@@ -27,7 +32,7 @@ class Story(Base):
     owner_id = Column(Integer, ForeignKey("users.id"), nullable=True)
     genre = Column(String, nullable=False)
     title = Column(String, nullable=False)  # пока можно оставить nullable
-    config = Column(JSON, nullable=False)  # сюда кладём sys.json / payload
+    config = Column(JSONB, nullable=False)  # сюда кладём sys.json / payload
     cover_url = Column(Text, nullable=True)
     npc_avatars = Column(JSON, nullable=True, default=dict)
     created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
@@ -42,15 +47,39 @@ class Story(Base):
         "StoryTurn",
         back_populates="story",
         cascade="all, delete-orphan",
+        passive_deletes=True,  # ходы удаляет сама БД (ON DELETE CASCADE)
         order_by="StoryTurn.id",
+        # случайная ленивая подгрузка (N+1 в списках) падает сразу;
+        # ходы читаются запросами story.get_turns / add_turn
+        lazy="raise",
     )
 
 
+# поиск историй по ключам конфига (config ? 'yc_agent_prompt_id', config @> ...)
+Index("ix_stories_config_gin", Story.config, postgresql_using="gin")
+# списки /stories: свои истории и шаблоны, новые первыми — чтение индекса
+# уже в нужном порядке, без сортировки; шаблонов мало, для них частичный
+Index("ix_stories_owner_updated", Story.owner_id, Story.updated_at.desc())
+Index(
+    "ix_stories_templates_updated",
+    Story.updated_at.desc(),
+    postgresql_where=Story.owner_id.is_(None),
+)
+
+
 class StoryTurn(Base):
     __tablename__ = "story_turns"
 
     id = Column(Integer, primary_key=True, index=True)
-    story_id = Column(Integer, ForeignKey("stories.id"), nullable=False, index=True)
-    turns = Column(JSON, nullable=False, default=list)
+    story_id = Column(
+        Integer,
+        ForeignKey("stories.id", ondelete="CASCADE"),
+        nullable=False,
+    )
+    # JSONB: ходы дописываются на стороне БД оператором ||
+    turns = Column(JSONB, nullable=False, default=list, server_default=text("'[]'::jsonb"))
     yc_previous_response_id = Column(String, nullable=False)
-    story = relationship("Story", back_populates="turns")
\ No newline at end of file
+    story = relationship("Story", back_populates="turns")
+
+    # ровно одна строка с ходами на историю — на этом построен upsert в add_turn
+    __table_args__ = (UniqueConstraint("story_id", name="uq_story_turns_story"),)
\ No newline at end of file
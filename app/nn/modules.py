@@ -1,15 +1,32 @@
 import re
-from typing import List
+from typing import Iterable, Tuple
 from app.schemas import InferenceRequest
 from .base import Module
 
+
+def _compile_keywords(keywords: Iterable[str]) -> "re.Pattern[str]":
+    """Регулярка, находящая любое из ключевых слов как подстроку."""
+    return re.compile("|".join(re.escape(w) for w in keywords))
+
+
+# ключевые слова уже в нижнем регистре: сравниваются с req.message_lower;
+# регулярки собираются один раз при импорте, а не в каждом экземпляре
+_GREETING_KWS = ("привет", "здрав", "hello", "hi")
+_ACTION_KWS = ("идти", "атак", "взять", "осмотреть", "open", "go")
+
+# одна скомпилированная альтернатива вместо цикла подстрок на каждый запрос
+_GREETING_RE = _compile_keywords(_GREETING_KWS)
+_ACTION_RE = _compile_keywords(_ACTION_KWS)
+# без группы захвата; IGNORECASE вместо приведения сообщения к нижнему регистру
+_LORE_RE = re.compile(r"мир|локаци|персонаж|сеттинг", re.IGNORECASE)
+
+
 class GreetingModule(Module):
     def __init__(self):
         super().__init__("greeting")
 
     def score(self, req: InferenceRequest) -> float:
-        txt = req.message.lower()
-        return 1.0 if any(w in txt for w in ["привет", "здрав", "hello", "hi"]) else 0.0
+        return 1.0 if _GREETING_RE.search(req.message_lower) else 0.0
 
     def run(self, req: InferenceRequest) -> str:
         return "Принято. Вы в Сториграде. Кратко опишите, что хотите сделать в мире истории."
@@ -19,7 +36,7 @@ class LoreModule(Module):
         super().__init__("lore")
 
     def score(self, req: InferenceRequest) -> float:
-        return 1.0 if re.search(r"(мир|локаци|персонаж|сеттинг)", req.message.lower()) else 0.0
+        return 1.0 if _LORE_RE.search(req.message) else 0.0
 
     def run(self, req: InferenceRequest) -> str:
         return "Опишите локацию, время, цель. Я предложу три стартовых сцены."
@@ -29,8 +46,7 @@ class ActionModule(Module):
         super().__init__("action")
 
     def score(self, req: InferenceRequest) -> float:
-        txt = req.message.lower()
-        return 0.8 if any(w in txt for w in ["идти", "атак", "взять", "осмотреть", "open", "go"]) else 0.0
+        return 0.8 if _ACTION_RE.search(req.message_lower) else 0.0
 
     def run(self, req: InferenceRequest) -> str:
         return "Действие принято. Сформирую ответ ведущего и последствия." 
@@ -46,5 +62,9 @@ class FallbackModule(Module):
         return "Опишите цель. Доступны: создание мира, выбор роли, действие."
 
 
-def default_modules() -> List[Module]:
-    return [GreetingModule(), LoreModule(), ActionModule(), FallbackModule()]
\ No newline at end of file
+# модули без состояния: один набор на процесс, собирается при импорте
+DEFAULT_MODULES: Tuple[Module, ...] = (GreetingModule(), LoreModule(), ActionModule(), FallbackModule())
+
+
+def default_modules() -> Tuple[Module, ...]:
+    return DEFAULT_MODULES
\ No newline at end of file
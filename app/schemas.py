@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from typing import List, Dict, Any, Optional, Literal
 
 class InferenceRequest(BaseModel):
@@ -6,6 +6,15 @@ class InferenceRequest(BaseModel):
     context: Optional[List[str]] = Field(default=None, description="Optional short context lines")
     meta: Optional[Dict[str, Any]] = Field(default=None, description="Client metadata")
 
+    _message_lower: Optional[str] = PrivateAttr(default=None)
+
+    @property
+    def message_lower(self) -> str:
+        """message.lower(), computed once and shared by all pipeline modules."""
+        if self._message_lower is None:
+            self._message_lower = self.message.lower()
+        return self._message_lower
+
 class TraceItem(BaseModel):
     module: str
     accepted: bool
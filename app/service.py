@@ -1,20 +1,33 @@
-from dataclasses import dataclass
-from typing import List, Tuple
+from dataclasses import dataclass, field
+from typing import Callable, List, Tuple
 from app.schemas import InferenceRequest, TraceItem
-from app.nn.modules import default_modules
+from app.nn.modules import DEFAULT_MODULES
+
+# тот же порог, что и у Module.decide по умолчанию
+_ACCEPT_THRESHOLD = 0.5
 
 @dataclass
 class Pipeline:
     modules: list
+    # (name, score, run) с уже связанными методами: в цикле нет поиска атрибутов
+    # и промежуточного кортежа из decide
+    _steps: Tuple[Tuple[str, Callable[[InferenceRequest], float], Callable[[InferenceRequest], str]], ...] = field(
+        init=False, repr=False
+    )
+
+    def __post_init__(self) -> None:
+        self._steps = tuple((m.name, m.score, m.run) for m in self.modules)
 
     def run(self, req: InferenceRequest) -> Tuple[str, List[TraceItem]]:
         trace: List[TraceItem] = []
         outputs: List[str] = []
-        for m in self.modules:
-            ok, s = m.decide(req)
-            out = m.run(req) if ok else ""
-            trace.append(TraceItem(module=m.name, accepted=ok, output=out, score=s))
-            if ok and m.name != "fallback":
+        for name, score, run in self._steps:
+            s = score(req)
+            ok = s >= _ACCEPT_THRESHOLD
+            out = run(req) if ok else ""
+            # поля заведомо валидны — model_construct пропускает валидацию pydantic
+            trace.append(TraceItem.model_construct(module=name, accepted=ok, output=out, score=s))
+            if ok and name != "fallback":
                 outputs.append(out)
                 break  # one-shot routing; fallback handles the rest
         if not outputs:
@@ -23,10 +36,35 @@ class Pipeline:
         reply = "\n".join(filter(None, outputs))
         return reply, trace
 
-_pipeline: Pipeline | None = None
+    def run_batch(self, reqs: List[InferenceRequest]) -> List[Tuple[str, List[TraceItem]]]:
+        """
+        То же, что run(), для пачки запросов: каждый модуль проходит по всем
+        ещё не распределённым запросам подряд, а не запрос по всем модулям.
+        """
+        traces: List[List[TraceItem]] = [[] for _ in reqs]
+        replies: List[str] = [""] * len(reqs)
+        pending = list(range(len(reqs)))
+        for name, score, run in self._steps:
+            if not pending:
+                break
+            still_pending = []
+            for i in pending:
+                req = reqs[i]
+                s = score(req)
+                ok = s >= _ACCEPT_THRESHOLD
+                out = run(req) if ok else ""
+                traces[i].append(TraceItem.model_construct(module=name, accepted=ok, output=out, score=s))
+                if ok:
+                    # и fallback, и обычный модуль дают ответ; после не-fallback
+                    # запрос дальше не идёт
+                    replies[i] = out
+                if not (ok and name != "fallback"):
+                    still_pending.append(i)
+            pending = still_pending
+        return list(zip(replies, traces))
+
+# создаётся при импорте: без ленивой инициализации и гонки первых запросов
+_pipeline = Pipeline(modules=DEFAULT_MODULES)
 
 def get_pipeline() -> Pipeline:
-    global _pipeline
-    if _pipeline is None:
-        _pipeline = Pipeline(modules=default_modules())
     return _pipeline
\ No newline at end of file
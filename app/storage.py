@@ -1,24 +1,93 @@
+import asyncio
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import BinaryIO, Iterator, Optional, Tuple
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import boto3
-import os
+from boto3.s3.transfer import TransferConfig
+
+from .config import settings
 
 
 
 S3_ENDPOINT = "https://storage.yandexcloud.net"
 S3_REGION = "ru-central1"
-S3_BUCKET = os.getenv("S3_BUCKET")
-S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
-S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
+S3_BUCKET = settings.S3_BUCKET
+S3_ACCESS_KEY = settings.S3_ACCESS_KEY
+S3_SECRET_KEY = settings.S3_SECRET_KEY
 # You can override this with a CDN / custom domain if you have one.
-PUBLIC_CDN_URL = os.getenv("PUBLIC_CDN_URL") or (
+PUBLIC_CDN_URL = settings.PUBLIC_CDN_URL or (
     f"{S3_ENDPOINT}/{S3_BUCKET}" if S3_BUCKET else S3_ENDPOINT
 )
 
 # Basic upload limits
-MAX_IMAGE_SIZE_BYTES = int(os.getenv("MAX_IMAGE_SIZE_BYTES") or str(5 * 1024 * 1024))
-ALLOWED_IMAGE_EXTS = {"png", "jpg", "jpeg", "webp"}
-DISALLOWED_CONTENT_TYPES = {"image/svg+xml"}
+MAX_IMAGE_SIZE_BYTES = settings.MAX_IMAGE_SIZE_BYTES
+
+
+_S3_CONFIG = Config(
+    signature_version="s3v4",
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    # пул соединений на все потоки воркера, без повторных TLS-рукопожатий
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    # контрольные суммы тела считаем только там, где их требует API,
+    # а не лишним проходом по каждой загружаемой картинке
+    request_checksum_calculation="when_required",
+    response_checksum_validation="when_required",
+)
+
+
+# части по 5 МБ грузятся параллельно, если лимит размера когда-нибудь поднимут
+_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=5 * 1024 * 1024,
+    multipart_chunksize=5 * 1024 * 1024,
+    max_concurrency=8,
+)
+
+
+@lru_cache(maxsize=1)
+def get_s3_client():
+    """
+    Единственный S3-клиент процесса.
+
+    Сборка клиента (модели сервиса, резолвер эндпоинтов, подписчик) дорогая,
+    поэтому делаем её один раз; клиенты botocore потокобезопасны.
+    """
+    return boto3.session.Session().client(
+        "s3",
+        endpoint_url=S3_ENDPOINT,
+        region_name=S3_REGION,
+        aws_access_key_id=S3_ACCESS_KEY,
+        aws_secret_access_key=S3_SECRET_KEY,
+        config=_S3_CONFIG,
+    )
+
+
+_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# сигнатуры поддерживаемых форматов; 12 байт хватает на RIFF....WEBP
+_SNIFF_BYTES = 12
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Content-type картинки по первым байтам или None, если формат не наш."""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+class ImageNotModified(Exception):
+    """Объект не менялся с присланного клиентом ETag (ответ 304)."""
+
+    def __init__(self, etag: str):
+        super().__init__(etag)
+        self.etag = etag
 
 
 class ImageStorage:
@@ -30,47 +99,99 @@ class ImageStorage:
         if not S3_SECRET_KEY:
             raise RuntimeError("S3_SECRET_KEY is not set")
 
-        self.client = boto3.client(
-            "s3",
-            endpoint_url=S3_ENDPOINT,
-            region_name=S3_REGION,
-            aws_access_key_id=S3_ACCESS_KEY,
-            aws_secret_access_key=S3_SECRET_KEY,
-        )
+        self.client = get_s3_client()
+        # отдельный пул: загрузки не занимают общий threadpool воркера
+        self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="s3-upload")
 
-    def upload_image(self, file_bytes: bytes, content_type: str) -> str:
-        """Загружает картинку и возвращает публичный URL."""
+    def upload_image(self, fileobj: BinaryIO, content_type: str, size: int) -> str:
+        """
+        Загружает картинку потоком из file-like объекта и возвращает публичный URL.
 
-        if content_type in DISALLOWED_CONTENT_TYPES:
-            raise ValueError("Unsupported image type")
+        Тип определяется по сигнатуре первых байт, а не по заголовку клиента:
+        SVG/HTML под видом image/png не пройдут.
+        """
 
-        if len(file_bytes) > MAX_IMAGE_SIZE_BYTES:
+        if size > MAX_IMAGE_SIZE_BYTES:
             raise ValueError("Image too large")
 
+        head = fileobj.read(_SNIFF_BYTES)
+        fileobj.seek(0)
+        sniffed = sniff_image_type(head)
+        if sniffed is None:
+            raise ValueError("Unsupported image type")
+        content_type = sniffed
+
         # Derive extension from content-type
         # e.g. image/jpeg -> jpeg
-        ext = (content_type or "").split("/")[-1].lower().strip()
-        if ext == "jpg":
-            ext = "jpeg"
-
-        if ext not in ALLOWED_IMAGE_EXTS:
-            raise ValueError("Unsupported image type")
+        ext = content_type.split("/")[-1]
 
         key = f"images/{uuid.uuid4()}.{ext}"
 
         try:
-            self.client.put_object(
-                Bucket=S3_BUCKET,
-                Key=key,
-                Body=file_bytes,
-                ContentType=content_type,
-                ACL="public-read",
+            # upload_fileobj читает поток частями (multipart для больших
+            # файлов), не собирая весь файл в один bytes
+            self.client.upload_fileobj(
+                fileobj,
+                S3_BUCKET,
+                key,
+                ExtraArgs={"ContentType": content_type, "ACL": "public-read"},
+                Config=_TRANSFER_CONFIG,
             )
         except ClientError as e:
             raise RuntimeError(e.response["Error"]) from e
 
         return f"{PUBLIC_CDN_URL}/{key}"
 
+    async def upload_image_async(self, fileobj: BinaryIO, content_type: str, size: int) -> str:
+        """upload_image в пуле потоков: event loop не ждёт ответа S3."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, partial(self.upload_image, fileobj, content_type, size)
+        )
+
+
+    def get_image(
+        self, key: str, if_none_match: Optional[str] = None
+    ) -> Tuple[Iterator[bytes], str, str, Optional[int]]:
+        """
+        Возвращает (поток тела частями, content-type, ETag, размер).
+
+        Тело не собирается в один bytes: чанки по _DOWNLOAD_CHUNK_SIZE
+        отдаются клиенту по мере чтения из S3.
+
+        Если ETag совпал с if_none_match, S3 не отдаёт тело вовсе —
+        бросаем ImageNotModified.
+        """
+        params = {"Bucket": S3_BUCKET, "Key": key}
+        if if_none_match:
+            params["IfNoneMatch"] = if_none_match
+
+        try:
+            obj = self.client.get_object(**params)
+        except ClientError as e:
+            code = str(e.response.get("Error", {}).get("Code"))
+            if code in ("304", "NotModified"):
+                raise ImageNotModified(if_none_match) from e
+            if code in ("404", "NoSuchKey"):
+                raise FileNotFoundError(key) from e
+            raise RuntimeError(e.response["Error"]) from e
+
+        content_type = obj.get("ContentType") or "application/octet-stream"
+        return (
+            _iter_body(obj["Body"]),
+            content_type,
+            obj.get("ETag", ""),
+            obj.get("ContentLength"),
+        )
+
+
+def _iter_body(body) -> Iterator[bytes]:
+    """Читает StreamingBody частями и закрывает соединение в конце."""
+    try:
+        yield from body.iter_chunks(_DOWNLOAD_CHUNK_SIZE)
+    finally:
+        body.close()
+
 
 # singleton-экземпляр
 image_storage = ImageStorage()
\ No newline at end of file
@@ -1,14 +1,57 @@
 # app/story_crud.py
 from typing import List, Optional, Dict, Any
 
+import orjson
+from sqlalchemy import Row, bindparam, cast, func, insert, literal_column, select, update
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
 from sqlalchemy.orm import Session
-from sqlalchemy import func, or_
 
 from . import models
 
 
 # ---------- Истории ----------
 
+# Сериализованные описания NPC и игрока для переменных agent prompt.
+# Считаются при записи конфига, а не на каждом ходе рассказчика.
+NPC_DESCRIPTION_JSON_KEY = "_npc_description_json"
+PLAYER_DESCRIPTION_JSON_KEY = "_player_description_json"
+
+
+def with_prompt_cache(config: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Копия конфига с заново посчитанными сериализованными описаниями.
+
+    Присланные клиентом значения этих ключей всегда перезаписываются,
+    поэтому устаревший кеш в конфиге не переживёт правку описаний.
+    """
+    if config is None:
+        return None
+    prepared = dict(config)
+    # orjson пишет UTF-8 как есть (аналог ensure_ascii=False), но в разы быстрее
+    prepared[NPC_DESCRIPTION_JSON_KEY] = orjson.dumps(
+        config.get("NPC_description", [])
+    ).decode("utf-8")
+    prepared[PLAYER_DESCRIPTION_JSON_KEY] = orjson.dumps(
+        config.get("player_description", {})
+    ).decode("utf-8")
+    return prepared
+
+
+_PROMPT_CACHE_KEYS = frozenset({NPC_DESCRIPTION_JSON_KEY, PLAYER_DESCRIPTION_JSON_KEY})
+
+
+def without_prompt_cache(config: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Конфиг для ответа API — без служебных ключей кеша промпта.
+
+    Они нужны только рассказчику: фронту они не интересны, а в ответе
+    дублировали бы описания ещё раз, экранированной JSON-строкой.
+    """
+    if not config:
+        return config
+    return {k: v for k, v in config.items() if k not in _PROMPT_CACHE_KEYS}
+
+
 def create_story(
     db: Session,
     owner_id: int | None,
@@ -17,20 +60,48 @@ def create_story(
     genre: str = "Fantasy",
     cover_url: str | None = None,
     npc_avatars: Dict[str, str] | None = None,
-) -> models.Story:
-    """Создать историю и сохранить её конфиг (sys.json/payload)."""
-    story = models.Story(
+) -> int:
+    """
+    Создать историю и сохранить её конфиг (sys.json/payload), вернуть её id.
+
+    INSERT ... RETURNING id и инкремент stories_count владельца идут
+    одной транзакцией — один commit и никакого refresh после него.
+    """
+    story_id = db.execute(
+        insert(models.Story)
+        .values(
+            owner_id=owner_id,
+            title=title,
+            genre=genre,
+            config=with_prompt_cache(config),
+            cover_url=cover_url,
+            npc_avatars=npc_avatars,
+        )
+        .returning(models.Story.id)
+    ).scalar_one()
+
+    if owner_id is not None:
+        db.execute(
+            update(models.User)
+            .where(models.User.id == owner_id)
+            .values(stories_count=models.User.stories_count + 1)
+        )
+
+    db.commit()
+    return story_id
+
+
+def copy_story(db: Session, source: models.Story, owner_id: int) -> int:
+    """Скопировать историю (шаблон или свою) пользователю, вернуть id копии."""
+    return create_story(
+        db=db,
         owner_id=owner_id,
-        title=title,
-        genre=genre,
-        config=config,
-        cover_url=cover_url,
-        npc_avatars=npc_avatars,
+        title=source.title,
+        genre=source.genre,
+        config=source.config,
+        cover_url=getattr(source, "cover_url", None),
+        npc_avatars=getattr(source, "npc_avatars", None),
     )
-    db.add(story)
-    db.commit()
-    db.refresh(story)
-    return story
 
 
 def get_story(db: Session, story_id: int, owner_id: int) -> Optional[models.Story]:
@@ -38,33 +109,39 @@ def get_story(db: Session, story_id: int, owner_id: int) -> Optional[models.Stor
     Получить историю по id, к которой есть доступ у пользователя:
     - либо его личная (owner_id = owner_id),
     - либо шаблонная (owner_id IS NULL).
+
+    Чистый поиск по PK через Session.get (сначала identity map),
+    владелец проверяется уже в Python.
     """
-    return (
-        db.query(models.Story)
-        .filter(
-            models.Story.id == story_id,
-            or_(
-                models.Story.owner_id == owner_id,
-                models.Story.owner_id.is_(None),
-            ),
-        )
-        .first()
-    )
+    story = db.get(models.Story, story_id)
+    if story is None or story.owner_id not in (owner_id, None):
+        return None
+    return story
 
 
-def list_stories_for_user(db: Session, owner_id: int) -> List[models.Story]:
-    """Список всех историй пользователя (включая шаблоны)."""
-    return (
-        db.query(models.Story)
-        .filter(
-            or_(
-                models.Story.owner_id == owner_id,
-                models.Story.owner_id.is_(None),
-            )
-        )
-        .order_by(models.Story.updated_at.desc())
-        .all()
-    )
+# Запросы списков собираются один раз при импорте: на вызове только
+# подставляется owner_id, а скомпилированный SQL берётся из кеша engine.
+_TEMPLATE_STORIES_STMT = (
+    select(models.Story)
+    .where(models.Story.owner_id.is_(None))
+    .order_by(models.Story.updated_at.desc())
+)
+
+_OWNED_STORIES_STMT = (
+    select(models.Story)
+    .where(models.Story.owner_id == bindparam("owner_id"))
+    .order_by(models.Story.updated_at.desc())
+)
+
+
+def list_template_stories(db: Session) -> List[models.Story]:
+    """Список шаблонных историй (owner_id IS NULL), новые первыми."""
+    return list(db.execute(_TEMPLATE_STORIES_STMT).scalars())
+
+
+def list_owned_stories(db: Session, owner_id: int) -> List[models.Story]:
+    """Список личных историй пользователя (без шаблонов), новые первыми."""
+    return list(db.execute(_OWNED_STORIES_STMT, {"owner_id": owner_id}).scalars())
 
 
 
@@ -76,51 +153,73 @@ def add_turn(
     user_text: str,
     model_text: str,
     yc_previous_response_id: str | None = None,
-) -> models.StoryTurn:
-    # Пытаемся найти существующую запись с ходами для этой истории и пользователя
-    turn_row = (
-        db.query(models.StoryTurn)
-        .filter(
-            models.StoryTurn.story_id == story_id,
-        )
-        .order_by(models.StoryTurn.id.asc())
-        .first()
-    )
-
-    # Если ещё не было записей, создаём новую
-    if not turn_row:
-        turn_row = models.StoryTurn(
-            story_id=story_id,
-            turns=[],
-            yc_previous_response_id=yc_previous_response_id,
-        )
-        db.add(turn_row)
-        db.flush()  # чтобы получить id при необходимости
+) -> Row:
+    """
+    Дописать ход в story_turns и вернуть строку (id, turns).
 
-    # Обновляем массив ходов
-    current_turns = list(turn_row.turns or [])
-    current_turns.append(
+    Новый ход дописывается на стороне БД (jsonb ||): по сети уходит
+    только он, а не весь массив истории. Всё — одним запросом.
+    """
+    new_turns = [
         {
             "user_text": user_text,
             "model_text": model_text,
         }
-    )
-    turn_row.turns = current_turns
-
+    ]
+
+    # Одна строка story_turns на историю (uq_story_turns_story): вставка
+    # первого хода и дописывание следующих — один INSERT ... ON CONFLICT
+    set_: Dict[str, Any] = {
+        "turns": func.coalesce(models.StoryTurn.turns, cast([], JSONB)).op("||")(
+            cast(new_turns, JSONB)
+        ),
+    }
     # Сохраняем previous_response_id именно в story_turns (per user, per story)
     if yc_previous_response_id:
-        turn_row.yc_previous_response_id = yc_previous_response_id
+        set_["yc_previous_response_id"] = yc_previous_response_id
 
+    upsert = (
+        pg_insert(models.StoryTurn)
+        .values(
+            story_id=story_id,
+            turns=new_turns,
+            # NOT NULL проверяется и у строки, ушедшей в ON CONFLICT,
+            # поэтому без id ответа вставляем пустую строку
+            yc_previous_response_id=yc_previous_response_id or "",
+        )
+        .on_conflict_do_update(index_elements=["story_id"], set_=set_)
+        .returning(models.StoryTurn.id, models.StoryTurn.turns)
+        .cte("upserted_turns")
+    )
     # Обновим updated_at истории (без хранения yc_previous_response_id в stories)
-    db.query(models.Story).filter(models.Story.id == story_id).update(
-        {"updated_at": func.now()}
+    # в том же запросе — data-modifying CTE
+    touch_story = (
+        update(models.Story)
+        .where(models.Story.id == story_id)
+        .values(updated_at=func.now())
+        .cte("touched_story")
     )
+    turn_row = db.execute(
+        select(upsert.c.id, upsert.c.turns).add_cte(touch_story)
+    ).one()
 
     db.commit()
-    db.refresh(turn_row)
     return turn_row
 
 
+# последние $n элементов массива; в lax-режиме начало среза,
+# ушедшее за 0 у коротких историй, обрезается до первого хода
+_TAIL_TURNS_PATH = literal_column("'$[last - $n + 1 to last]'::jsonpath")
+
+_TAIL_TURNS_STMT = select(
+    func.jsonb_path_query_array(
+        models.StoryTurn.turns,
+        _TAIL_TURNS_PATH,
+        func.jsonb_build_object("n", bindparam("limit")),
+    )
+).where(models.StoryTurn.story_id == bindparam("story_id"))
+
+
 def get_turns(
     db: Session,
     story_id: int,
@@ -129,23 +228,14 @@ def get_turns(
     """
     Получить последние N ходов истории (по умолчанию 50).
 
+    Срез делает сама БД (jsonb_path_query_array): по сети идут только
+    N ходов, а не вся история.
+
     Возвращает список словарей формата:
       {"user_text": "...", "model_text": "..."}
     """
-    turn_row = (
-        db.query(models.StoryTurn)
-        .filter(
-            models.StoryTurn.story_id == story_id,
-        )
-        .order_by(models.StoryTurn.id.asc())
-        .first()
-    )
-
-    if not turn_row or not turn_row.turns:
-        return []
+    turns = db.execute(
+        _TAIL_TURNS_STMT, {"story_id": story_id, "limit": limit}
+    ).scalar_one_or_none()
 
-    all_turns = list(turn_row.turns)
-    if len(all_turns) <= limit:
-        return all_turns
-    # последние N ходов
-    return all_turns[-limit:]
\ No newline at end of file
+    return list(turns or [])
@@ -1,89 +1,217 @@
-import os
-import json
-import openai
-from dotenv import load_dotenv
-from typing import Any
+import asyncio
+import hashlib
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
-from sqlalchemy.orm import Session
-from sqlalchemy import or_
+import openai
+import orjson
+from sqlalchemy import bindparam, or_, select
 
 from . import models, story as story_crud
+from .config import settings
+from .db import SessionLocal
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-client = openai.OpenAI(
-    api_key=os.getenv("YANDEX_CLOUD_API_KEY"),
-    base_url=os.getenv(
-        "YANDEX_CLOUD_BASE_URL", "https://rest-assistant.api.cloud.yandex.net/v1"
-    ),
-    project=os.getenv("YANDEX_CLOUD_PROJECT"),
-)
+
+class StoryNotFound(ValueError):
+    """История не найдена или у пользователя нет к ней доступа."""
+
+
+class StoryStepFailed(RuntimeError):
+    """Модель не ответила (или оборвала поток) — ход не состоялся."""
+
+
+def _reply_key(story_id: int, response_id: str, mode: str, user_input: str) -> bytes:
+    h = hashlib.blake2b(digest_size=16)
+    # пробелы по краям — не другой ход (поле ввода, двойная отправка)
+    for part in (str(story_id), response_id, mode, user_input.strip()):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.digest()
+
+
+# Тот же ход, пришедший, пока первый ещё ждёт модель (двойной клик, повтор
+# клиента по таймауту), не запускает второй вызов LLM, а ждёт ответа первого.
+# Ключ — состояние *до* хода (previous_response_id), и живёт он только пока
+# ход идёт: то же "продолжай" после ответа — уже новый ход, а не повтор.
+# Живёт только в event loop, поэтому без блокировки.
+# Результат future — текст хода или None, если ход не удался.
+_IN_FLIGHT: Dict[bytes, "asyncio.Future[Optional[str]]"] = {}
+
+_UNAVAILABLE_REPLY = "Сейчас рассказчик недоступен, попробуйте ещё раз позже."
+
+
+def _claim_in_flight(key: bytes) -> Optional["asyncio.Future[Optional[str]]"]:
+    """None, если ход начат этим запросом; иначе future уже идущего хода."""
+    in_flight = _IN_FLIGHT.get(key)
+    if in_flight is not None:
+        return in_flight
+    _IN_FLIGHT[key] = asyncio.get_running_loop().create_future()
+    return None
+
+
+def _release_in_flight(key: bytes, text: Optional[str]) -> None:
+    fut = _IN_FLIGHT.pop(key, None)
+    if fut is not None and not fut.done():
+        fut.set_result(text)
 
 
-def generate_story_step(
-    db: Session,
+# Ответ уходит клиенту только после commit хода: иначе следующий ход
+# (в том числе на другом воркере) прочитал бы старый previous_response_id,
+# а перезагрузка истории не увидела бы только что показанный ход.
+# Сама запись — задача, переживающая обрыв запроса (shield); ходы одной
+# истории пишутся строго по порядку, а остановка воркера дожидается их.
+_PENDING_SAVES: Dict[int, "asyncio.Task[None]"] = {}
+
+
+def _save_turn(
     story_id: int,
-    user_id: int,
-    user_input: str,
-    mode: str = "dialogue",  # режим: dialogue / narration / directive
-) -> str:
-    """
-    Основной вход для Storyteller-mini в серверном режиме.
+    user_text: str,
+    model_text: str,
+    yc_previous_response_id: Optional[str],
+) -> None:
+    # своя сессия: соединение берётся только на время записи
+    with SessionLocal() as db:
+        story_crud.add_turn(
+            db=db,
+            story_id=story_id,
+            user_text=user_text,
+            model_text=model_text,
+            yc_previous_response_id=yc_previous_response_id,
+        )
 
-    Использует Yandex Cloud Responses API с agent prompt.
-    Поддерживает передачу previous_response_id для контекста и непрерывности диалога.
 
-    ВАЖНО: yc_previous_response_id хранится в story_turns (per user, per story),
-    а не в story.config, чтобы шаблоны не делили контекст между пользователями.
-    """
+def _schedule_save_turn(
+    story_id: int,
+    user_text: str,
+    model_text: str,
+    yc_previous_response_id: Optional[str],
+) -> "asyncio.Task[None]":
+    previous = _PENDING_SAVES.get(story_id)
 
-    # 1. Находим историю и проверяем владельца
-    story = (
-        db.query(models.Story)
-        .filter(
-            models.Story.id == story_id,
-            or_(
-                models.Story.owner_id == user_id,
-                models.Story.owner_id.is_(None),
-            ),
+    async def run() -> None:
+        # ходы одной истории пишутся строго по порядку
+        if previous is not None:
+            await asyncio.wait([previous])
+        await asyncio.to_thread(
+            _save_turn, story_id, user_text, model_text, yc_previous_response_id
         )
-        .first()
+
+    task = asyncio.create_task(run())
+    _PENDING_SAVES[story_id] = task
+
+    def done(t: "asyncio.Task[None]") -> None:
+        if _PENDING_SAVES.get(story_id) is t:
+            del _PENDING_SAVES[story_id]
+        # ошибку логируем здесь: ждавший запрос мог уже оборваться
+        if not t.cancelled() and t.exception() is not None:
+            logger.error(
+                "Failed to save story turn",
+                exc_info=t.exception(),
+                extra={"story_id": story_id},
+            )
+
+    task.add_done_callback(done)
+    return task
+
+
+async def _persist_turn(
+    story_id: int,
+    user_text: str,
+    model_text: str,
+    yc_previous_response_id: Optional[str],
+) -> None:
+    """Записать ход и дождаться commit; ошибка записи пробрасывается."""
+    await asyncio.shield(
+        _schedule_save_turn(story_id, user_text, model_text, yc_previous_response_id)
     )
-    if not story:
-        raise ValueError("История не найдена или нет доступа")
-
-    # 2. Берём previous_response_id из story_turns (последняя запись для этого пользователя)
-    prev_turn = (
-        db.query(models.StoryTurn)
-        .filter(
-            models.StoryTurn.story_id == story_id,
-        )
-        .order_by(models.StoryTurn.id.desc())
-        .first()
+
+
+async def _wait_pending_save(story_id: int) -> None:
+    task = _PENDING_SAVES.get(story_id)
+    if task is not None:
+        await asyncio.wait([task])
+
+
+async def drain_pending_saves() -> None:
+    """Дождаться всех незавершённых записей ходов (при остановке приложения)."""
+    if _PENDING_SAVES:
+        await asyncio.wait(list(_PENDING_SAVES.values()))
+
+
+# Сообщение хода для агента; системный промпт рендерит сам agent prompt
+_TURN_MESSAGE_TEMPLATE = "Тип хода: {mode}\nХод пользователя: {user_input}"
+
+
+# Собирается один раз при импорте: на каждом ходе только подставляются
+# параметры, а скомпилированный SQL берётся из кеша engine.
+# Строка ходов у истории одна (uq_story_turns_story), поэтому хватает одного JOIN.
+_STORY_CONTEXT_STMT = (
+    select(models.Story.config, models.StoryTurn.yc_previous_response_id)
+    .outerjoin(models.StoryTurn, models.StoryTurn.story_id == models.Story.id)
+    .where(
+        models.Story.id == bindparam("story_id"),
+        or_(
+            models.Story.owner_id == bindparam("user_id"),
+            models.Story.owner_id.is_(None),
+        ),
     )
+)
+
+
+def _load_story_context(story_id: int, user_id: int) -> Tuple[Dict[str, Any], str]:
+    """
+    Конфиг доступной пользователю истории и последний previous_response_id.
+
+    Своя короткая сессия: соединение возвращается в пул сразу после чтения,
+    а не висит idle in transaction, пока ход секундами ждёт модель.
+    """
+    # 1-2. История с проверкой владельца и previous_response_id из story_turns
+    with SessionLocal() as db:
+        row = db.execute(
+            _STORY_CONTEXT_STMT, {"story_id": story_id, "user_id": user_id}
+        ).one_or_none()
+    if row is None:
+        raise StoryNotFound("История не найдена или нет доступа")
+
+    config, yc_previous_response_id = row
+    return config or {}, yc_previous_response_id or ""
+
+
+def _resolve_user_name(user_field_val: str) -> str:
+    """
+    Имя игрока из "Имя — описание" (или "Имя - описание").
+
+    Длинное тире важнее дефиса, чтобы "Анна-Мария — воительница" дала
+    "Анна-Мария": partition за один проход вместо пары `in` + split.
+    """
+    name, sep, _ = user_field_val.partition("—")
+    if not sep:
+        name = user_field_val.partition("-")[0]
+    return name.strip()
+
 
-    config = story.config or {}
+def _build_request_kwargs(
+    config: Dict[str, Any],
+    yc_previous_response_id: str,
+    user_input: str,
+    mode: str,
+) -> Dict[str, Any]:
+    """Аргументы responses.create для хода: agent prompt, переменные и input."""
     story_description = config.get("story_description", "")
     player_description = config.get("player_description", {})
     npc_description = config.get("NPC_description", [])
     start_phrase = config.get("start_phrase", "")
-    yc_agent_prompt_id = config.get("yc_agent_prompt_id") or os.getenv(
-        "YANDEX_CLOUD_AGENT_PROMPT_ID"
-    )
-
-    yc_previous_response_id = (
-        prev_turn.yc_previous_response_id
-        if prev_turn and prev_turn.yc_previous_response_id
-        else ""
-    )
+    yc_agent_prompt_id = config.get("yc_agent_prompt_id") or settings.YANDEX_CLOUD_AGENT_PROMPT_ID
 
     if not yc_agent_prompt_id:
         raise ValueError("Не задан yc_agent_prompt_id / YANDEX_CLOUD_AGENT_PROMPT_ID")
 
-    if not os.getenv("YANDEX_CLOUD_API_KEY"):
+    if not settings.YANDEX_CLOUD_API_KEY:
         raise ValueError("Не задан YANDEX_CLOUD_API_KEY")
 
-    if not os.getenv("YANDEX_CLOUD_PROJECT"):
+    if not settings.YANDEX_CLOUD_PROJECT:
         raise ValueError("Не задан YANDEX_CLOUD_PROJECT")
 
     # 3. Resolve user name from player_description (agent variables expect plain strings)
@@ -95,24 +223,30 @@ def generate_story_step(
         user_field_val = player_description
 
     if isinstance(user_field_val, str):
-        if "—" in user_field_val:
-            resolved_user_name = user_field_val.split("—", 1)[0].strip()
-        elif "-" in user_field_val:
-            resolved_user_name = user_field_val.split("-", 1)[0].strip()
-        else:
-            resolved_user_name = user_field_val.strip()
+        resolved_user_name = _resolve_user_name(user_field_val)
 
     # 4. Build variables dict for agent prompt
+    # описания сериализуются при записи конфига (story.with_prompt_cache);
+    # старые конфиги без кеша сериализуем на месте
+    npc_description_json = config.get(story_crud.NPC_DESCRIPTION_JSON_KEY)
+    if npc_description_json is None:
+        npc_description_json = orjson.dumps(npc_description).decode("utf-8")
+    player_description_json = config.get(story_crud.PLAYER_DESCRIPTION_JSON_KEY)
+    if player_description_json is None:
+        player_description_json = orjson.dumps(player_description).decode("utf-8")
+
     variables = {
-        "NPC_description": json.dumps(npc_description, ensure_ascii=False),
+        "NPC_description": npc_description_json,
         "story_description": str(story_description),
         "user": resolved_user_name,
-        "player_description": json.dumps(player_description, ensure_ascii=False),
+        "player_description": player_description_json,
         "mode": str(mode),
     }
 
     # 5. Build input payload
-    user_message_text = f"Тип хода: {mode}\nХод пользователя: {user_input}".strip()
+    user_message_text = _TURN_MESSAGE_TEMPLATE.format_map(
+        {"mode": mode, "user_input": user_input}
+    ).strip()
 
     # For the very first turn for this user in this story, seed the agent with start_phrase
     # as if it was the previous assistant message.
@@ -130,16 +264,83 @@ def generate_story_step(
     else:
         input_payload = user_message_text
 
-    # 6. Call Yandex Cloud responses.create
+    kwargs: Dict[str, Any] = {
+        "prompt": {"id": yc_agent_prompt_id, "variables": variables},
+        "input": input_payload,
+    }
+    if yc_previous_response_id:
+        kwargs["previous_response_id"] = yc_previous_response_id
+    return kwargs
+
+
+async def _prepare_turn(
+    story_id: int,
+    user_id: int,
+    user_input: str,
+    mode: str,
+) -> Tuple[bytes, Dict[str, Any]]:
+    """
+    Ключ хода для коалесцирования и аргументы responses.create.
+
+    Все ошибки доступа (StoryNotFound) и конфига (ValueError) — здесь,
+    до захвата ключа: иначе незавершённый future навсегда повесил бы
+    дубли этого хода.
+    """
+    await _wait_pending_save(story_id)
+    config, yc_previous_response_id = await asyncio.to_thread(
+        _load_story_context, story_id, user_id
+    )
+    key = _reply_key(story_id, yc_previous_response_id, mode, user_input)
+    kwargs = _build_request_kwargs(config, yc_previous_response_id, user_input, mode)
+    return key, kwargs
+
+
+async def generate_story_step(
+    llm: openai.AsyncOpenAI,
+    story_id: int,
+    user_id: int,
+    user_input: str,
+    mode: str = "dialogue",  # режим: dialogue / narration / directive
+) -> str:
+    """
+    Основной вход для Storyteller-mini в серверном режиме.
+
+    Использует Yandex Cloud Responses API с agent prompt.
+    Поддерживает передачу previous_response_id для контекста и непрерывности диалога.
+
+    ВАЖНО: yc_previous_response_id хранится в story_turns (per user, per story),
+    а не в story.config, чтобы шаблоны не делили контекст между пользователями.
+
+    Ответ модели ждём в event loop (AsyncOpenAI); синхронные запросы к БД
+    уходят в поток, чтобы не блокировать loop. Ответ возвращается только
+    после commit хода; если ход не удалось сохранить, клиент получает
+    сообщение о недоступности, а не текст, которого нет в истории.
+    """
+    key, kwargs = await _prepare_turn(story_id, user_id, user_input, mode)
+
+    in_flight = _claim_in_flight(key)
+    if in_flight is not None:
+        story_text = await asyncio.shield(in_flight)
+        return story_text if story_text is not None else _UNAVAILABLE_REPLY
+
+    story_text = None
     try:
-        kwargs = {
-            "prompt": {"id": yc_agent_prompt_id, "variables": variables},
-            "input": input_payload,
-        }
-        if yc_previous_response_id:
-            kwargs["previous_response_id"] = yc_previous_response_id
+        story_text = await _generate_turn(llm, story_id, kwargs, user_input)
+    finally:
+        _release_in_flight(key, story_text)
+    return story_text if story_text is not None else _UNAVAILABLE_REPLY
+
 
-        response = client.responses.create(**kwargs)
+async def _generate_turn(
+    llm: openai.AsyncOpenAI,
+    story_id: int,
+    kwargs: Dict[str, Any],
+    user_input: str,
+) -> Optional[str]:
+    """Один вызов модели для хода и запись его в story_turns; None при ошибке."""
+    # 6. Call Yandex Cloud responses.create
+    try:
+        response = await llm.responses.create(**kwargs)
 
         story_text = getattr(response, "output_text", None)
         if not story_text:
@@ -148,20 +349,86 @@ def generate_story_step(
             except Exception:
                 story_text = ""
 
-    except Exception as e:
-        print("Yandex Cloud error in generate_story_step:", repr(e))
-        return "Сейчас рассказчик недоступен, попробуйте ещё раз позже."
+    except Exception:
+        logger.exception("Yandex Cloud error in generate_story_step", extra={"story_id": story_id})
+        return None
 
     # 7. Persist new response id for continuity (per-user, per-story)
     new_response_id = getattr(response, "id", None)
 
     # 8. Save the turn in DB + store yc_previous_response_id in story_turns
-    story_crud.add_turn(
-        db=db,
-        story_id=story_id,
-        user_text=user_input,
-        model_text=story_text,
-        yc_previous_response_id=new_response_id,
-    )
+    try:
+        await _persist_turn(story_id, user_input, story_text, new_response_id)
+    except Exception:
+        # уже залогировано в _schedule_save_turn
+        return None
 
     return story_text
+
+
+async def prepare_story_stream(
+    llm: openai.AsyncOpenAI,
+    story_id: int,
+    user_id: int,
+    user_input: str,
+    mode: str = "dialogue",
+) -> AsyncIterator[str]:
+    """
+    То же, что generate_story_step, но текст отдаётся кусками по мере генерации.
+
+    Доступ к истории и конфиг проверяются сразу (StoryNotFound / ValueError),
+    чтобы эндпоинт успел ответить ошибкой до заголовков SSE; возвращается
+    итератор кусков текста. Если модель не ответила или оборвала поток,
+    итератор бросает StoryStepFailed — оборванный ответ не выдаётся за полный.
+    Ход сохраняется после того, как поток модели завершился целиком, и
+    итератор заканчивается только после commit; ошибка записи — тоже
+    StoryStepFailed.
+    """
+    key, kwargs = await _prepare_turn(story_id, user_id, user_input, mode)
+    return _stream_turn(llm, story_id, key, kwargs, user_input)
+
+
+async def _stream_turn(
+    llm: openai.AsyncOpenAI,
+    story_id: int,
+    key: bytes,
+    kwargs: Dict[str, Any],
+    user_input: str,
+) -> AsyncIterator[str]:
+    # дубль идущего хода получает его текст целиком, когда тот завершится
+    in_flight = _claim_in_flight(key)
+    if in_flight is not None:
+        story_text = await asyncio.shield(in_flight)
+        if story_text is None:
+            raise StoryStepFailed(_UNAVAILABLE_REPLY)
+        yield story_text
+        return
+
+    parts: List[str] = []
+    story_text = None
+    try:
+        new_response_id = None
+        try:
+            stream = await llm.responses.create(**kwargs, stream=True)
+            # async with закрывает HTTP-ответ и при обрыве клиента
+            async with stream:
+                async for event in stream:
+                    if event.type == "response.output_text.delta":
+                        parts.append(event.delta)
+                        yield event.delta
+                    elif event.type == "response.completed":
+                        new_response_id = event.response.id
+        except Exception as exc:
+            logger.exception("Yandex Cloud error in story stream", extra={"story_id": story_id})
+            raise StoryStepFailed(_UNAVAILABLE_REPLY) from exc
+
+        full_text = "".join(parts)
+        try:
+            await _persist_turn(story_id, user_input, full_text, new_response_id)
+        except Exception as exc:
+            # done клиенту — только после commit: несохранённый ход не выдаём за полный
+            raise StoryStepFailed(_UNAVAILABLE_REPLY) from exc
+        story_text = full_text
+    finally:
+        # оборванный поток — неудавшийся ход и для дублей
+        _release_in_flight(key, story_text)